@@ -1,30 +1,68 @@
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
 import pathlib
-import re
+import sys
+import time
+try:
+    # google's RE2 runs the alternation as a DFA with no backtracking; only
+    # the `pyre2` wrapper is a drop-in replacement though, and the official
+    # `google-re2` binding shares the module name without the re-style API,
+    # so probe a compile with our flags before committing to the engine
+    import re2 as re
+    re.compile('x', re.IGNORECASE | re.MULTILINE)
+except (ImportError, AttributeError, TypeError):
+    try:
+        # next best: the third-party `regex` engine, whose compiled scanner
+        # beats stdlib `re` on anchored alternations and is API compatible
+        import regex as re
+    except ImportError:
+        import re
 import git
 import jira
 
 
-class RepoReader:
-    _skip_patterns = [
-        re.compile(r'^preparing development version.+', re.IGNORECASE),
-        re.compile(r'^preparing hbase release.+', re.IGNORECASE),
-        re.compile(r'^\s*updated? pom.xml version (for|to) .+', re.IGNORECASE),
-        re.compile(r'^\s*updated? chang', re.IGNORECASE),
-        re.compile(r'^\s*updated? (book|docs|documentation)', re.IGNORECASE),
-        re.compile(r'^\s*updating (docs|changes).+', re.IGNORECASE),
-        re.compile(r'^\s*bump (pom )?versions?', re.IGNORECASE),
-        re.compile(r'^\s*updated? (version|poms|changes).+', re.IGNORECASE),
-    ]
-    _identify_leading_jira_id_patterns = [
-        re.compile(r'^[\s\[]*(hbase-\d+)', re.IGNORECASE),
-        re.compile(r'^[\s\[]*(hbse-\d+)', re.IGNORECASE),  # typo
-        re.compile(r'^[\s\[]*(hbae-\d+)', re.IGNORECASE),  # typo
-        re.compile(r'^[\s\[]*(hbase \d+)', re.IGNORECASE), # typo
-    ]
+# single alternation covering both the skip list and the JIRA id (with its
+# typo variants), so each block of subjects is classified in one findall
+_SUMMARY_PATTERN = re.compile(
+    r'^[\s\[]*(?:'
+    r'(?P<skip>preparing (?:development version|hbase release)'
+    r'|updated? (?:pom\.xml|chang|book|docs|documentation|version|poms|changes)'
+    r'|updating (?:docs|changes)'
+    r'|bump (?:pom )?versions?)'
+    r'|(?P<jira>hb(?:ase|se|ae)[- ]\d+)'
+    r')', re.IGNORECASE | re.MULTILINE)
+
+# below this many subjects a single in-process findall wins; above it the
+# blocks are spread across cores
+_PARALLEL_EXTRACT_THRESHOLD = 10000
+
+
+def _normalize_jira_id(jira_id):
+    # normalize the typo variants (HBSE-/HBAE-/'HBASE ') without another pass
+    # through the regex engine: the issue number after the separator is all we
+    # need; interned so the same id in different sets shares one string object
+    return sys.intern('HBASE-' + jira_id.split('-' if '-' in jira_id else ' ', 1)[1])
+
+
+def _extract_jira_ids(subjects):
+    # module level rather than a method so multiprocessing workers can pickle
+    # a reference to it
+    return {_normalize_jira_id(jira_id)
+            for skip, jira_id in _SUMMARY_PATTERN.findall(subjects) if jira_id}
 
+
+class RepoReader:
     def __init__(self, repo):
-        self._repo = git.Repo(pathlib.Path(repo).absolute())
+        # GitCmdObjectDB streams object lookups through one persistent
+        # `git cat-file` process instead of the pure-python db, which is the
+        # right trade-off for read-only traversal of a large repo; disabling
+        # optional locks avoids lockfile churn while the long log runs
+        self._repo = git.Repo(pathlib.Path(repo).absolute(), odbt=git.GitCmdObjectDB)
+        self._repo.git.update_environment(GIT_OPTIONAL_LOCKS='0')
 
     def merge_base(self, release_branch, previous_release_branch):
         commit = self._repo.merge_base(release_branch, previous_release_branch)
@@ -32,80 +70,135 @@ class RepoReader:
             return commit[0]
         raise Exception(f'can not find merge base for {release_branch} and {previous_release_branch}')
 
-    @staticmethod
-    def _skip(summary):
-        return any([p.match(summary) for p in RepoReader._skip_patterns])
-
-    @staticmethod
-    def extract_leading_jira_id(commit):
-        if RepoReader._skip(commit.summary):
-            return None
-        for pattern in RepoReader._identify_leading_jira_id_patterns:
-            match = pattern.match(commit.summary)
-            if match:
-                return re.sub(r'HBSE-|HBAE-|HBASE ', 'HBASE-', match.groups()[0].upper())
-        return None
-
     def get_jira_issues_from_commits(self, start_commit, end_commit):
-        commits = list(self._repo.iter_commits(f'{start_commit}...{end_commit}'))
-        num_commits = len(commits)
-        print(f'there are {num_commits} commits from {start_commit} to {end_commit}')
-        issues = []
-        for commit in commits:
-            issue = RepoReader.extract_leading_jira_id(commit)
-            if issue:
-                issues.append(issue)
+        # one `git log` call for the whole range, instead of letting GitPython
+        # fetch each commit object lazily; git's own PCRE grep pre-filters to
+        # jira-tagged commits so non-matching subjects never cross the process
+        # boundary, and the surviving subjects (one per line) are scanned by a
+        # single multiline findall so the regex engine stays in C instead of
+        # being re-entered once per commit
+        log_args = (f'{start_commit}...{end_commit}', '--format=%s', '--no-merges')
+        try:
+            raw = self._repo.git.log('--perl-regexp', '-i',
+                                     r'--grep=^[\s\[]*hb(ase|se|ae)[- ]\d+', *log_args)
+        except git.GitCommandError:
+            # git built without libpcre rejects --perl-regexp; the grep is
+            # only a prefilter and the findall below does the exact
+            # extraction, so fall back to streaming every subject
+            raw = self._repo.git.log(*log_args)
+        num_commits = raw.count('\n') + 1 if raw else 0
+        if num_commits < _PARALLEL_EXTRACT_THRESHOLD:
+            issues = _extract_jira_ids(raw)
+        else:
+            # extraction is embarrassingly parallel: split the subjects into
+            # one block per core and let each worker run its own findall,
+            # re-interning the merged keys since interning does not survive
+            # the pickle round trip
+            lines = raw.split('\n')
+            block_size = -(-num_commits // os.cpu_count())
+            blocks = ['\n'.join(lines[i:i + block_size])
+                      for i in range(0, num_commits, block_size)]
+            with multiprocessing.Pool() as pool:
+                issues = {sys.intern(issue)
+                          for block_issues in pool.map(_extract_jira_ids, blocks)
+                          for issue in block_issues}
+        print(f'there are {num_commits} commits to scan from {start_commit} to {end_commit}')
         return issues
 
 
+_JQL_TEMPLATE = 'project = HBase AND resolution = Fixed AND fixVersion IN (%s)'
+
+
 class JiraReader:
+    # rerunning the audit while tweaking the ignore lists should not refetch
+    # the same issue list from jira every time
+    _cache_dir = pathlib.Path('~/.cache/hbase-audit').expanduser()
+    _cache_ttl_seconds = 3600
+
     def __init__(self, jira_url):
         self._jira = jira.JIRA(jira_url)
 
     @staticmethod
     def construct_jql(fix_versions):
-        fix_versions_condition = ','.join(fix_versions)
-        return f'project = HBase AND resolution = Fixed AND fixVersion IN ({fix_versions_condition})'
+        return _JQL_TEMPLATE % ','.join(fix_versions)
 
     def fetch_issues(self, fix_versions):
-        start_at = 0
         max_results = 50
         jql = JiraReader.construct_jql(fix_versions)
         print('executing jql: ' + jql)
+        cache_file = JiraReader._cache_dir / (hashlib.sha1(jql.encode()).hexdigest() + '.json')
+        if cache_file.exists() and \
+                time.time() - cache_file.stat().st_mtime < JiraReader._cache_ttl_seconds:
+            with open(cache_file) as f:
+                issues = [sys.intern(key) for key in json.load(f)]
+            print(f'loaded {len(issues)} issues from cache file {cache_file}')
+            return issues
+        # the first page tells us the total, then the remaining pages can be
+        # fetched concurrently instead of one serial round trip per page
+        first_page = self._jira.search_issues(jql, 0, max_results, fields='key', json_result=True)
+        pages = [first_page]
+        total = first_page['total']
+        if total > max_results:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                pages.extend(executor.map(
+                    lambda start_at: self._jira.search_issues(jql, start_at, max_results,
+                                                              fields='key', json_result=True),
+                    range(max_results, total, max_results)))
         issues = []
-        while True:
-            issue_list = self._jira.search_issues(jql, start_at, max_results)
-            issues.extend(issue.key for issue in issue_list)
-            start_at += len(issue_list)
-            if start_at >= issue_list.total:
-                break
+        for page in pages:
+            issues.extend(sys.intern(issue['key']) for issue in page['issues'])
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(issues, f)
+        tmp_file.replace(cache_file)
         return issues
 
 
-def missed_issues_in_previous_release(issues_in_git_commits, issues_in_git_commits_previous_release,
-                                      ignore_missing_in_current_release):
+_IN_CURRENT, _IN_PREVIOUS, _IN_JIRA = 1, 2, 4
+
+
+def partition_issues(issues_in_git_commits, issues_in_git_commits_previous_release, issues_in_jira):
+    # one pass over the union, tagging each issue with a 3-bit membership
+    # mask, instead of walking the overlapping sets once per pairwise
+    # difference
+    only_in_previous = set()
+    jira_not_in_git = set()
+    git_not_in_jira = set()
+    for issue in issues_in_git_commits | issues_in_git_commits_previous_release | issues_in_jira:
+        tag = ((issue in issues_in_git_commits)
+               | ((issue in issues_in_git_commits_previous_release) << 1)
+               | ((issue in issues_in_jira) << 2))
+        release_window = tag & (_IN_CURRENT | _IN_PREVIOUS)
+        if release_window == _IN_PREVIOUS:
+            only_in_previous.add(issue)
+        if tag == _IN_CURRENT:
+            git_not_in_jira.add(issue)
+        if tag & _IN_JIRA and release_window != _IN_CURRENT:
+            jira_not_in_git.add(issue)
+    return only_in_previous, jira_not_in_git, git_not_in_jira
+
+
+def missed_issues_in_previous_release(only_in_previous, ignore_missing_in_current_release):
     print('Commit to previous release but not in current release:')
-    for issue in sorted(filter(lambda i: i not in ignore_missing_in_current_release,
-                               issues_in_git_commits_previous_release.difference(issues_in_git_commits))):
+    for issue in sorted(only_in_previous - ignore_missing_in_current_release):
         print('\t' + issue)
 
 
-def audit_jira_issues_and_git_commits(issues_in_jira, issues_in_git_commits, ignore_missing_in_git,
+def audit_jira_issues_and_git_commits(jira_not_in_git, git_not_in_jira, ignore_missing_in_git,
                                       ignore_missing_in_jira):
     print('Issues in jira but not in git commits:')
-    for issue in sorted(filter(lambda i: i not in ignore_missing_in_git,
-                               issues_in_jira.difference(issues_in_git_commits))):
+    for issue in sorted(jira_not_in_git - ignore_missing_in_git):
         print('\t' + issue)
     print('Issues in git commits but not in jira:')
-    for issue in sorted(filter(lambda i: i not in ignore_missing_in_jira,
-                               issues_in_git_commits.difference(issues_in_jira))):
+    for issue in sorted(git_not_in_jira - ignore_missing_in_jira):
         print('\t' + issue)
 
 
 def read_jira_issues_from_file(file):
     if file:
         with open(file) as f:
-            return set(l.split()[0] for l in f.readlines())
+            return {sys.intern(l.split(None, 1)[0]) for l in f if l.strip()}
     else:
         return set()
 
@@ -155,17 +248,18 @@ if __name__ == '__main__':
     args = parser.parse_args()
     repo = RepoReader(args.repo)
     merge_base = repo.merge_base(args.release_branch, args.previous_release_branch)
-    issues_in_git_commits = set(repo.get_jira_issues_from_commits(merge_base, args.release_branch))
-    issues_in_git_commits_previous_release = set(
-        repo.get_jira_issues_from_commits(merge_base, 'rel/' + args.previous_release_version))
-    ignore_missing_in_current_release = read_jira_issues_from_file(args.ignore_missing_in_current_release)
-    missed_issues_in_previous_release(issues_in_git_commits, issues_in_git_commits_previous_release,
-                                      ignore_missing_in_current_release)
+    issues_in_git_commits = repo.get_jira_issues_from_commits(merge_base, args.release_branch)
+    issues_in_git_commits_previous_release = repo.get_jira_issues_from_commits(
+        merge_base, 'rel/' + args.previous_release_version)
 
     jira = JiraReader('https://issues.apache.org/jira')
     issues_in_jira = set(jira.fetch_issues(args.release_versions.split(',')))
+
+    only_in_previous, jira_not_in_git, git_not_in_jira = partition_issues(
+        issues_in_git_commits, issues_in_git_commits_previous_release, issues_in_jira)
+    ignore_missing_in_current_release = read_jira_issues_from_file(args.ignore_missing_in_current_release)
     ignore_missing_in_git = read_jira_issues_from_file(args.ignore_missing_in_git)
     ignore_missing_in_jira = read_jira_issues_from_file(args.ignore_missing_in_jira)
-    audit_jira_issues_and_git_commits(issues_in_jira,
-                                      issues_in_git_commits.difference(issues_in_git_commits_previous_release),
+    missed_issues_in_previous_release(only_in_previous, ignore_missing_in_current_release)
+    audit_jira_issues_and_git_commits(jira_not_in_git, git_not_in_jira,
                                       ignore_missing_in_git, ignore_missing_in_jira)